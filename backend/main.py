@@ -1,19 +1,30 @@
 import os
+import asyncio
 import secrets
 import httpx
-import json
-from math import radians, cos, sin, asin, sqrt
+import orjson
+import hashlib
+import diskcache
+import numpy as np
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from math import radians, cos
+from cachetools import TTLCache
 from pydantic import BaseModel, Field
 from typing import Literal
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from pydantic import BaseModel
 
-load_dotenv()
+if os.getenv("DISABLE_DOTENV", "").lower() not in {"1", "true", "yes"}:
+    load_dotenv()
 
 RADIUS_M = 10000  # 10 km
+MAX_CANDIDATES = 20  # cafes requested from Places and handed to OpenAI
 
 PLACES_SEARCH_URL = "https://places.googleapis.com/v1/places:searchNearby"
 PLACES_FIELD_MASK = ",".join([
@@ -33,6 +44,20 @@ PREFERENCE_DICT = {
     "open": "Pick cafes that are open right now (open_now true). If many are open, prioritize closer + better rated.",
     "busy": "Pick popular/lively cafes: prioritize high rating_count (busy proxy), then rating, then distance.",
 }
+OPENAI_MODEL = "gpt-4o-mini"
+PICK_SYSTEM_PROMPT = "You are selecting the best cafes from a provided list. Follow the rules strictly."
+PICK_RULES = [
+    "Return exactly 5 cafe picks from the provided list, if less than 5 cafes are provided, return as many as provided.",
+    "Each pick must be one of the provided places.",
+    "No duplicate place IDs, therfore no duplicate picks.",
+    "keep the 'why' reasoning concise, ie 1-2 sentences.",
+    "tags should only be a 4 short strings that capture key attributes of the cafe."
+]
+_places_cache = TTLCache(maxsize=1024, ttl=300)
+_places_inflight: dict[tuple[float, float], asyncio.Task] = {}
+PICKS_CACHE_TTL_S = 86400
+_picks_cache = diskcache.Cache(os.getenv("PICKS_CACHE_DIR", "/tmp/cafe_cache"))
+
 APP_BASIC_USER = os.getenv("APP_BASIC_USER", "")
 APP_BASIC_PASS = os.getenv("APP_BASIC_PASS", "")
 GOOGLE_PLACES_API_KEY = os.getenv("GOOGLE_PLACES_API_KEY")
@@ -44,9 +69,32 @@ if not GOOGLE_PLACES_API_KEY:
 elif not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY is not set")
 
-app = FastAPI()
+elif not (APP_BASIC_USER and APP_BASIC_PASS):
+    raise RuntimeError("APP_BASIC_USER and APP_BASIC_PASS must be set")
+
+_BASIC_USER_BYTES = APP_BASIC_USER.encode("utf-8")
+_BASIC_PASS_BYTES = APP_BASIC_PASS.encode("utf-8")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+        headers={
+            "Content-Type": "application/json",
+            "X-Goog-Api-Key": GOOGLE_PLACES_API_KEY,
+            "X-Goog-FieldMask": PLACES_FIELD_MASK,
+        },
+    )
+    yield
+    await app.state.http.aclose()
+    await openai_client.close()
+    _picks_cache.close()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 security = HTTPBasic()
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=DefaultAsyncHttpxClient(http2=True))
 
 preference = Literal["study", "friendly", "best", "open", "busy"]
 
@@ -63,9 +111,22 @@ class CafePick(BaseModel):
 class CafePicksResponse(BaseModel):
     picks: list[CafePick]
 
+@dataclass(slots=True)
+class Cafe:
+    place_id: str
+    name: str
+    address: str
+    lat: float
+    lng: float
+    rating: float | None
+    rating_count: int | None
+    open_now: bool | None
+    price_level: str | None
+    distance_m: float = 0.0
+
 def require_basic_auth(credentials: HTTPBasicCredentials = Depends(security)):
-    correct_username = secrets.compare_digest(credentials.username, APP_BASIC_USER)
-    correct_password = secrets.compare_digest(credentials.password, APP_BASIC_PASS)
+    correct_username = secrets.compare_digest(credentials.username.encode("utf-8"), _BASIC_USER_BYTES)
+    correct_password = secrets.compare_digest(credentials.password.encode("utf-8"), _BASIC_PASS_BYTES)
     if not (correct_username and correct_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -74,57 +135,77 @@ def require_basic_auth(credentials: HTTPBasicCredentials = Depends(security)):
         )
     return credentials.username
 
-def haversine_m(lat1, lon1, lat2, lon2):
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-    c = 2 * asin(sqrt(a))
-    r = 6371000
+def haversine_m(user_lat: float, user_lng: float, cafes: list[Cafe]) -> np.ndarray:
+    lats = np.fromiter((c.lat for c in cafes), dtype=np.float64, count=len(cafes))
+    lngs = np.fromiter((c.lng for c in cafes), dtype=np.float64, count=len(cafes))
+    user_lat_r = radians(user_lat)
+    user_lng_r = radians(user_lng)
+    cos_user_lat = cos(user_lat_r)
+    lats_r = np.radians(lats)
+    dlat = lats_r - user_lat_r
+    dlng = np.radians(lngs) - user_lng_r
+    a = np.sin(dlat / 2) ** 2 + cos_user_lat * np.cos(lats_r) * np.sin(dlng / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1.0 - a))
+    r = 6371000.0
     return c * r
 
-def normalize_place(p: dict, user_lat: float, user_lng: float) -> dict | None:
+def normalize_place(p: dict) -> Cafe | None:
     place_id = p.get("id")
-    name = p.get("displayName", {}).get("text")
+    name = (p.get("displayName") or {}).get("text")
     address = p.get("shortFormattedAddress")
-    location = p.get("location", {})
+    location = p.get("location") or {}
     lat = location.get("latitude")
     lng = location.get("longitude")
 
-    #these must be present
-    if not (place_id and name and address and lat is None and lng is None):
+    # these must be present; 0.0 is a valid coordinate so check for None explicitly
+    if not (place_id and name and address) or lat is None or lng is None:
         return None
-    
+
     rating = p.get("rating")
     rating_count = p.get("userRatingCount")
-    open_now = p.get("currentOpeningHours", {}).get("openNow")
+    open_now = (p.get("currentOpeningHours") or {}).get("openNow")
     price_level = p.get("priceLevel")
 
-    distance_m = haversine_m(user_lat, user_lng, lat, lng)
-
-    return {
-        "place_id": place_id,
-        "name": name,
-        "address": address,
-        "lat": lat,
-        "lng": lng,
-        "rating": rating,
-        "rating_count": rating_count,
-        "open_now": open_now,
-        "price_level": price_level,
-        "distance_m": distance_m,
-    }
-
-async def fetch_nearby_cafes(lat: float, lng: float) -> list[dict]:
-    headers = {
-        "Content-Type": "application/json",
-        "X-Goog-Api-Key": GOOGLE_PLACES_API_KEY,
-        "X-Goog-FieldMask": PLACES_FIELD_MASK,
-    }
+    return Cafe(
+        place_id=place_id,
+        name=name,
+        address=address,
+        lat=lat,
+        lng=lng,
+        rating=rating,
+        rating_count=rating_count,
+        open_now=open_now,
+        price_level=price_level,
+    )
 
+def location_key(lat: float, lng: float) -> tuple[float, float]:
+    return (round(lat, 3), round(lng, 3))
+
+async def fetch_nearby_cafes(client: httpx.AsyncClient, lat: float, lng: float) -> list[dict]:
+    key = location_key(lat, lng)
+    cached = _places_cache.get(key)
+    if cached is not None:
+        return cached
+
+    task = _places_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_fetch_and_cache(client, key, lat, lng))
+        _places_inflight[key] = task
+    # shield so one caller disconnecting doesn't cancel the fetch for the others
+    return await asyncio.shield(task)
+
+async def _fetch_and_cache(client: httpx.AsyncClient, key: tuple[float, float], lat: float, lng: float) -> list[dict]:
+    try:
+        places = await _search_nearby(client, lat, lng)
+        _places_cache[key] = places
+        return places
+    finally:
+        _places_inflight.pop(key, None)
+
+async def _search_nearby(client: httpx.AsyncClient, lat: float, lng: float) -> list[dict]:
     body = {
         "includedTypes": ["cafe"],
-        "maxResultCount": 20,
+        "maxResultCount": MAX_CANDIDATES,
         "rankPreference": "DISTANCE",
         "locationRestriction": {
             "circle": {
@@ -137,97 +218,117 @@ async def fetch_nearby_cafes(lat: float, lng: float) -> list[dict]:
         }
     }
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        response = await client.post(
-            PLACES_SEARCH_URL,
-            headers=headers,
-            json=body
-        )
-        if response.status_code != 200:
-            # Show Google’s real error message
-            raise HTTPException(status_code=502, detail=response.text)
+    response = await client.post(PLACES_SEARCH_URL, content=orjson.dumps(body))
+    if response.status_code != 200:
+        # Show Google’s real error message
+        raise HTTPException(status_code=502, detail=response.text)
 
-        data = response.json()
+    data = orjson.loads(response.content)
 
     return data.get("places", [])
 
-async def openai_pick_5(preference: str, formatted_places: list[dict]) -> list[CafePick]:
+def picks_cache_key(preference: str, rubric: str, cafes: list[Cafe], location: tuple[float, float]) -> str:
+    # everything the reply depends on: model and prompt text, per-cafe fields sent to OpenAI,
+    # and the rounded user location standing in for the distances
+    candidates = sorted(((c.place_id, c.open_now, c.rating, c.rating_count) for c in cafes), key=lambda t: t[0])
+    payload = {
+        "model": OPENAI_MODEL,
+        "system": PICK_SYSTEM_PROMPT,
+        "rules": PICK_RULES,
+        "pref": preference,
+        "rubric": rubric,
+        "location": location,
+        "candidates": candidates,
+    }
+    return hashlib.blake2b(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+async def openai_pick_5(preference: str, formatted_places: list[Cafe], location: tuple[float, float]) -> CafePicksResponse:
     compacted_places = []
-    for p in formatted_places:
-        compacted_places.append({
-            "place_id": p["place_id"],
-            "name": p["name"],
-            "address": p["address"],
-            "rating": p.get("rating"),
-            "rating_count": p.get("rating_count"),
-            "open_now": p.get("open_now"),
-            "price_level": p.get("price_level"),
-            "distance_m": round(float(p["distance_m"]), 1),
-        })
-    
-    rubric = PREFERENCE_DICT.get(preference, PREFERENCE_DICT["best"])
-    allowed_ids = [p["place_id"] for p in compacted_places]
+    for c in formatted_places:
+        compacted = {
+            "place_id": c.place_id,
+            "name": c.name,
+            "rating": c.rating,
+            "rating_count": c.rating_count,
+            "open_now": c.open_now,
+            "distance_m": round(c.distance_m),
+        }
+        compacted_places.append({k: v for k, v in compacted.items() if v is not None})
+
+    rubric = PREFERENCE_DICT[preference]
+    allowed_ids = [c.place_id for c in formatted_places]
+
+    cache_key = picks_cache_key(preference, rubric, formatted_places, location)
+    cached = await run_in_threadpool(_picks_cache.get, cache_key)
+    if cached is not None:
+        return CafePicksResponse.model_validate_json(cached)
+
     prompt = {
         "rubric": rubric,
-        "rules": [
-            "Return exactly 5 cafe picks from the provided list, if less than 5 cafes are provided, return as many as provided.",
-            "Each pick must be one of the provided places.",
-            "No duplicate place IDs, therfore no duplicate picks.",
-            "keep the 'why' reasoning concise, ie 1-2 sentences.",
-            "tags should only be a 4 short strings that capture key attributes of the cafe."
-        ],
+        "rules": PICK_RULES,
         "allowed_place_ids": allowed_ids,
         "places": compacted_places
     }
 
-    response = openai_client.responses.parse(
-        model="gpt-4o-mini",
+    response = await openai_client.responses.parse(
+        model=OPENAI_MODEL,
         input=[
-            {"role": "system", "content": "You are selecting the best cafes from a provided list. Follow the rules strictly."},
-            {"role": "user", "content": json.dumps(prompt)},
+            {"role": "system", "content": PICK_SYSTEM_PROMPT},
+            {"role": "user", "content": orjson.dumps(prompt).decode()},
         ],
         text_format=CafePicksResponse,
     )
 
-    return response.output_parsed
+    picks = response.output_parsed
+    if picks is None:
+        raise HTTPException(status_code=502, detail="OpenAI returned no parseable picks")
+
+    pick_ids = [pick.place_id for pick in picks.picks]
+    if len(pick_ids) == len(set(pick_ids)) and set(pick_ids) <= set(allowed_ids):
+        await run_in_threadpool(_picks_cache.set, cache_key, picks.model_dump_json(), expire=PICKS_CACHE_TTL_S)
+    return picks
 
 @app.get("/health")
 def health():
     return {"ok": True}
 
 @app.post("/recommendations")
-async def recommendations(req: RecommendationRequest, _user: str = Depends(require_basic_auth)):
-    places = await fetch_nearby_cafes(req.lat, req.lng)
+async def recommendations(req: RecommendationRequest, request: Request, _user: str = Depends(require_basic_auth)):
+    places = await fetch_nearby_cafes(request.app.state.http, req.lat, req.lng)
 
     formatted_places = []
     for p in places:
-        normalized = normalize_place(p, req.lat, req.lng)
+        normalized = normalize_place(p)
         if normalized:
             formatted_places.append(normalized)
 
-    formatted_places.sort(key=lambda x: x["distance_m"])
+    distances = haversine_m(req.lat, req.lng, formatted_places)
+    for cafe, distance_m in zip(formatted_places, distances.tolist()):
+        cafe.distance_m = distance_m
+
+    formatted_places = [formatted_places[i] for i in np.argsort(distances)]
 
-    top_5 = await openai_pick_5(req.preference, formatted_places)   
+    top_5 = await openai_pick_5(req.preference, formatted_places, location_key(req.lat, req.lng))
 
-    dict_by_id = {c["place_id"]: c for c in formatted_places}
+    cafe_by_id = {c.place_id: c for c in formatted_places}
 
     final_places = []
     for pick in top_5.picks:
         print(pick) 
-        place_info = dict_by_id.get(pick.place_id)
+        place_info = cafe_by_id.get(pick.place_id)
         print(place_info == True)
         if place_info:
             final_places.append({
                 "place_id": pick.place_id,
-                "name": place_info["name"],
-                "address": place_info["address"],
-                "lat": place_info["lat"],
-                "lng": place_info["lng"],
-                "rating": place_info.get("rating"),
-                "rating_count": place_info.get("rating_count"),
-                "open_now": place_info.get("open_now"),
-                "price_level": place_info.get("price_level"),
-                "distance_m": round(float(place_info["distance_m"]), 1),
+                "name": place_info.name,
+                "address": place_info.address,
+                "lat": place_info.lat,
+                "lng": place_info.lng,
+                "rating": place_info.rating,
+                "rating_count": place_info.rating_count,
+                "open_now": place_info.open_now,
+                "price_level": place_info.price_level,
+                "distance_m": round(place_info.distance_m, 1),
                 "why": pick.why,
                 "tags": pick.tags,
             })
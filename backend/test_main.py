@@ -0,0 +1,313 @@
+import asyncio
+import math
+import os
+import tempfile
+
+os.environ.setdefault("DISABLE_DOTENV", "1")
+os.environ["PICKS_CACHE_DIR"] = tempfile.mkdtemp(prefix="cafe_cache_test_")
+os.environ.setdefault("GOOGLE_PLACES_API_KEY", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("APP_BASIC_USER", "test")
+os.environ.setdefault("APP_BASIC_PASS", "test")
+
+import diskcache
+import httpx
+import pytest
+from cachetools import TTLCache
+from fastapi import HTTPException
+
+import main
+
+LOCATION = (43.653, -79.383)
+
+
+def make_cafe(place_id: str, open_now: bool | None) -> main.Cafe:
+    return main.Cafe(
+        place_id=place_id,
+        name=f"Cafe {place_id}",
+        address="1 Main St",
+        lat=0.0,
+        lng=0.0,
+        rating=4.5,
+        rating_count=100,
+        open_now=open_now,
+        price_level=None,
+        distance_m=250.0,
+    )
+
+
+class FakeResponses:
+    def __init__(self):
+        self.calls = 0
+
+    async def parse(self, **kwargs):
+        self.calls += 1
+        picks = main.CafePicksResponse(picks=[main.CafePick(place_id="a", why="close", tags=["quiet"])])
+        return type("ParsedResponse", (), {"output_parsed": picks})()
+
+
+class FakeOpenAI:
+    def __init__(self):
+        self.responses = FakeResponses()
+
+
+def test_picks_cache_misses_when_open_now_changes(tmp_path, monkeypatch):
+    fake = FakeOpenAI()
+    cache = diskcache.Cache(str(tmp_path))
+    monkeypatch.setattr(main, "openai_client", fake)
+    monkeypatch.setattr(main, "_picks_cache", cache)
+
+    open_cafes = [make_cafe("a", True), make_cafe("b", True)]
+    closed_cafes = [make_cafe("a", False), make_cafe("b", True)]
+
+    asyncio.run(main.openai_pick_5("open", open_cafes, LOCATION))
+    asyncio.run(main.openai_pick_5("open", open_cafes, LOCATION))
+    assert fake.responses.calls == 1
+
+    asyncio.run(main.openai_pick_5("open", closed_cafes, LOCATION))
+    assert fake.responses.calls == 2
+    cache.close()
+
+
+def test_picks_cache_key_ignores_candidate_order():
+    cafes = [make_cafe("a", True), make_cafe("b", False)]
+    rubric = main.PREFERENCE_DICT["open"]
+    assert main.picks_cache_key("open", rubric, cafes, LOCATION) == main.picks_cache_key("open", rubric, cafes[::-1], LOCATION)
+
+
+class FixedOpenAI:
+    def __init__(self, picks):
+        self.calls = 0
+        self.responses = self
+        self._picks = picks
+
+    async def parse(self, **kwargs):
+        self.calls += 1
+        return type("ParsedResponse", (), {"output_parsed": self._picks})()
+
+
+def test_picks_with_unknown_place_id_are_not_cached(tmp_path, monkeypatch):
+    bad = main.CafePicksResponse(picks=[main.CafePick(place_id="made-up", why="x", tags=[])])
+    fake = FixedOpenAI(bad)
+    cache = diskcache.Cache(str(tmp_path))
+    monkeypatch.setattr(main, "openai_client", fake)
+    monkeypatch.setattr(main, "_picks_cache", cache)
+
+    cafes = [make_cafe("a", True)]
+    asyncio.run(main.openai_pick_5("best", cafes, LOCATION))
+    asyncio.run(main.openai_pick_5("best", cafes, LOCATION))
+    assert fake.calls == 2
+    assert len(cache) == 0
+    cache.close()
+
+
+def test_picks_with_duplicates_are_not_cached(tmp_path, monkeypatch):
+    dup = main.CafePicksResponse(picks=[
+        main.CafePick(place_id="a", why="x", tags=[]),
+        main.CafePick(place_id="a", why="y", tags=[]),
+    ])
+    cache = diskcache.Cache(str(tmp_path))
+    monkeypatch.setattr(main, "openai_client", FixedOpenAI(dup))
+    monkeypatch.setattr(main, "_picks_cache", cache)
+
+    asyncio.run(main.openai_pick_5("best", [make_cafe("a", True), make_cafe("b", True)], LOCATION))
+    assert len(cache) == 0
+    cache.close()
+
+
+def test_unparseable_openai_reply_is_502(tmp_path, monkeypatch):
+    cache = diskcache.Cache(str(tmp_path))
+    monkeypatch.setattr(main, "openai_client", FixedOpenAI(None))
+    monkeypatch.setattr(main, "_picks_cache", cache)
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(main.openai_pick_5("best", [make_cafe("a", True)], LOCATION))
+    assert exc.value.status_code == 502
+    assert len(cache) == 0
+    cache.close()
+
+
+def test_picks_cache_key_depends_on_location():
+    cafes = [make_cafe("a", True)]
+    rubric = main.PREFERENCE_DICT["study"]
+    here = main.picks_cache_key("study", rubric, cafes, LOCATION)
+    elsewhere = main.picks_cache_key("study", rubric, cafes, main.location_key(43.70, -79.40))
+    assert here != elsewhere
+
+
+def test_picks_cache_key_depends_on_model_and_rules(monkeypatch):
+    cafes = [make_cafe("a", True)]
+    rubric = main.PREFERENCE_DICT["best"]
+    before = main.picks_cache_key("best", rubric, cafes, LOCATION)
+    monkeypatch.setattr(main, "OPENAI_MODEL", "another-model")
+    assert main.picks_cache_key("best", rubric, cafes, LOCATION) != before
+    monkeypatch.undo()
+    monkeypatch.setattr(main, "PICK_RULES", main.PICK_RULES + ["New rule."])
+    assert main.picks_cache_key("best", rubric, cafes, LOCATION) != before
+
+
+def make_place(**overrides) -> dict:
+    place = {
+        "id": "abc",
+        "displayName": {"text": "Corner Cafe"},
+        "shortFormattedAddress": "1 Main St",
+        "location": {"latitude": 43.65, "longitude": -79.38},
+        "rating": 4.4,
+        "userRatingCount": 210,
+        "currentOpeningHours": {"openNow": True},
+        "priceLevel": "PRICE_LEVEL_MODERATE",
+    }
+    place.update(overrides)
+    return place
+
+
+def test_normalize_place_complete():
+    cafe = main.normalize_place(make_place())
+    assert cafe == main.Cafe(
+        place_id="abc",
+        name="Corner Cafe",
+        address="1 Main St",
+        lat=43.65,
+        lng=-79.38,
+        rating=4.4,
+        rating_count=210,
+        open_now=True,
+        price_level="PRICE_LEVEL_MODERATE",
+    )
+
+
+def test_normalize_place_keeps_zero_coordinates():
+    cafe = main.normalize_place(make_place(location={"latitude": 0.0, "longitude": 0.0}))
+    assert cafe is not None
+    assert (cafe.lat, cafe.lng) == (0.0, 0.0)
+
+
+@pytest.mark.parametrize("overrides", [
+    {"id": None},
+    {"id": ""},
+    {"displayName": {}},
+    {"displayName": {"text": ""}},
+    {"shortFormattedAddress": None},
+    {"shortFormattedAddress": ""},
+    {"location": {"latitude": 43.65}},
+    {"location": {"longitude": -79.38}},
+])
+def test_normalize_place_missing_required_field(overrides):
+    assert main.normalize_place(make_place(**overrides)) is None
+
+
+def test_normalize_place_tolerates_null_sub_objects():
+    assert main.normalize_place(make_place(displayName=None)) is None
+    assert main.normalize_place(make_place(location=None)) is None
+    cafe = main.normalize_place(make_place(currentOpeningHours=None))
+    assert cafe is not None
+    assert cafe.open_now is None
+
+
+@pytest.fixture
+def places_state(monkeypatch):
+    monkeypatch.setattr(main, "_places_cache", TTLCache(maxsize=16, ttl=300))
+    monkeypatch.setattr(main, "_places_inflight", {})
+
+
+def places_client(handler) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_concurrent_places_misses_share_one_call(places_state):
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"places": [make_place()]})
+
+    async def run():
+        async with places_client(handler) as client:
+            return await asyncio.gather(*[main.fetch_nearby_cafes(client, 43.65, -79.38) for _ in range(5)])
+
+    results = asyncio.run(run())
+    assert calls == 1
+    assert results == [[make_place()]] * 5
+    assert main._places_inflight == {}
+
+
+def test_places_failure_reaches_every_waiter_and_is_retried(places_state):
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return httpx.Response(500, text="upstream down")
+
+    async def run():
+        async with places_client(handler) as client:
+            results = await asyncio.gather(
+                *[main.fetch_nearby_cafes(client, 43.65, -79.38) for _ in range(3)],
+                return_exceptions=True,
+            )
+            assert calls == 1
+            assert all(isinstance(r, HTTPException) and r.status_code == 502 for r in results)
+            assert main._places_inflight == {}
+
+            with pytest.raises(HTTPException):
+                await main.fetch_nearby_cafes(client, 43.65, -79.38)
+            assert calls == 2
+
+    asyncio.run(run())
+    assert main.location_key(43.65, -79.38) not in main._places_cache
+
+
+def test_cancelling_only_waiter_still_fills_places_cache(places_state):
+    key = main.location_key(43.65, -79.38)
+
+    async def run():
+        started = asyncio.Event()
+
+        async def handler(request):
+            started.set()
+            await asyncio.sleep(0.01)
+            return httpx.Response(200, json={"places": [make_place()]})
+
+        async with places_client(handler) as client:
+            waiter = asyncio.create_task(main.fetch_nearby_cafes(client, 43.65, -79.38))
+            await started.wait()
+            inflight = main._places_inflight[key]
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+            await inflight
+
+    asyncio.run(run())
+    assert main._places_cache[key] == [make_place()]
+    assert main._places_inflight == {}
+
+
+def test_haversine_known_distance():
+    cafe = make_cafe("a", True)
+    cafe.lat = 0.01
+    distances = main.haversine_m(0.0, 0.0, [cafe])
+    assert distances.tolist() == [pytest.approx(1111.95, abs=0.01)]
+
+
+def test_haversine_matches_scalar_formula():
+    user_lat, user_lng = 43.6532, -79.3832
+    cafes = []
+    for lat, lng in [(43.6629, -79.3957), (43.6426, -79.3871), (45.5019, -73.5674)]:
+        cafe = make_cafe("a", True)
+        cafe.lat, cafe.lng = lat, lng
+        cafes.append(cafe)
+
+    def scalar(lat1, lng1, lat2, lng2):
+        lat1, lng1, lat2, lng2 = map(math.radians, [lat1, lng1, lat2, lng2])
+        a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+        return 2 * math.asin(math.sqrt(a)) * 6371000
+
+    expected = [scalar(user_lat, user_lng, c.lat, c.lng) for c in cafes]
+    assert main.haversine_m(user_lat, user_lng, cafes).tolist() == pytest.approx(expected, abs=1e-6)
+
+
+def test_haversine_empty():
+    assert main.haversine_m(0.0, 0.0, []).tolist() == []